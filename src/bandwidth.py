@@ -0,0 +1,119 @@
+# Bandwidth scheduling shared by the server's handler threads: token buckets for a global and a
+# per-client-IP ingest rate, with weighted fair sharing of the global rate between clients.
+import heapq
+import itertools
+import threading
+import time
+
+BURST_SECONDS = 0.1 # Bucket capacity, as seconds worth of the rate
+
+class TokenBucket:
+    def __init__(self, rate, burst_seconds=BURST_SECONDS):
+        self.rate = rate
+        self.capacity = rate * burst_seconds
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount):
+        # Take amount tokens, going into debt if needed, and sleep until the debt is repaid.
+        # Callers are served in arrival order. Returns the time spent throttled.
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class BandwidthScheduler:
+    def __init__(self, global_rate=None, client_rate=None, client_weights=None, burst_seconds=BURST_SECONDS):
+        self.global_rate = global_rate
+        self.client_rate = client_rate
+        self.client_weights = client_weights or {}
+        self.burst_seconds = burst_seconds
+        self.client_buckets = {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+        # Global bucket, shared with start-time fair queueing: each request gets a virtual finish
+        # tag (previous tag + bytes / weight) and the waiter with the lowest tag is served first
+        self.condition = threading.Condition()
+        self.tokens = global_rate * burst_seconds if global_rate else 0.0
+        self.last_refill = time.monotonic()
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def throttle(self, client_ip, amount):
+        # Account amount bytes received from client_ip, blocking while it is over its share.
+        # Returns the time spent throttled.
+        if not self.global_rate and not self.client_rate:
+            return 0.0
+        throttled = 0.0
+        if self.client_rate:
+            throttled += self._client_bucket(client_ip).consume(amount)
+        if self.global_rate:
+            throttled += self._consume_global(client_ip, amount)
+        with self.lock:
+            client_metrics = self.metrics.setdefault(client_ip, {'bytes': 0, 'throttled_time': 0.0})
+            client_metrics['bytes'] += amount
+            client_metrics['throttled_time'] += throttled
+        return throttled
+
+    def _client_bucket(self, client_ip):
+        with self.lock:
+            bucket = self.client_buckets.get(client_ip)
+            if bucket is None:
+                bucket = TokenBucket(self.client_rate, self.burst_seconds)
+                self.client_buckets[client_ip] = bucket
+            return bucket
+
+    def _consume_global(self, client_ip, amount):
+        start_time = time.monotonic()
+        with self.condition:
+            weight = self.client_weights.get(client_ip, 1.0)
+            start_tag = max(self.virtual_time, self.finish_tags.get(client_ip, 0.0))
+            finish_tag = start_tag + amount / weight
+            self.finish_tags[client_ip] = finish_tag
+            ticket = (finish_tag, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+
+            while True:
+                now = time.monotonic()
+                capacity = self.global_rate * self.burst_seconds
+                self.tokens = min(capacity, self.tokens + (now - self.last_refill) * self.global_rate)
+                self.last_refill = now
+                # Like TokenBucket the head may go into debt, which delays everyone behind it
+                if self.waiting[0] == ticket and self.tokens > 0:
+                    heapq.heappop(self.waiting)
+                    self.tokens -= amount
+                    self.virtual_time = start_tag
+                    self.condition.notify_all()
+                    break
+                timeout = -self.tokens / self.global_rate if self.tokens <= 0 else None
+                self.condition.wait(timeout)
+        return time.monotonic() - start_time
+
+    def snapshot(self):
+        # Copy of the per-client metrics: bytes accounted and time spent throttled
+        with self.lock:
+            return {client_ip: dict(client_metrics) for client_ip, client_metrics in self.metrics.items()}
+
+    def print_summary(self):
+        metrics = self.snapshot()
+        if not metrics:
+            return
+        print("Bandwidth scheduling summary:")
+        for client_ip, client_metrics in sorted(metrics.items()):
+            print(f"  {client_ip}: {client_metrics['bytes']} bytes, "
+                  f"throttled for {client_metrics['throttled_time']:.3f} seconds")
+
+# Default scheduler used when none is passed in; unlimited, so throttle() returns immediately
+NULL_SCHEDULER = BandwidthScheduler()
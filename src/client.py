@@ -3,31 +3,80 @@ import socket
 import ssl
 import time
 import argparse
+import os
 from datetime import datetime
+from tracing import Tracer, NULL_TRACER
+from memory_profile import MemoryMonitor, NULL_MONITOR
+from dedup import DEDUP_MAGIC, DIGEST_SIZE, split_chunks
+from multiplex import (MUX_MAGIC, FRAME_OPEN, FRAME_DATA, FRAME_END, FRAME_WINDOW, FRAME_ACK,
+                       MAX_FRAME_SIZE, INITIAL_WINDOW, FrameReader, ProtocolError, pack_frame, recv_exact)
 
 HOST = 'localhost'
 LOG_FILE = 'client_performance.log'
+MULTIPLEX_LOG_FILE = 'client_multiplex_performance.log'
+DEDUP_LOG_FILE = 'client_dedup_performance.log'
 DEBUG = True
 
-def log_performance(data_size, duration, use_tls):
-    # Log performance data to a CSV file
+def log_performance(data_size, duration, use_tls, memory_usage=None):
+    # Log performance data to a CSV file, followed by peak traced memory and RSS when measured
     connection_type = 'TLS' if use_tls else 'TCP'
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"{timestamp},{connection_type},{data_size},{duration:.6f}\n"
+    log_entry = f"{timestamp},{connection_type},{data_size},{duration:.6f}"
+    if memory_usage:
+        log_entry += f",{memory_usage['peak_traced']},{memory_usage['rss']}"
+    log_entry += "\n"
     try:
         with open(LOG_FILE, 'a') as log_file:
             log_file.write(log_entry)
     except IOError as e:
         print(f"Failed to write log entry: {e}")
 
+def log_multiplexed_performance(data_size, duration, streams, use_tls, memory_usage=None):
+    # Multiplexed streams overlap in time, so they get their own CSV instead of being compared
+    # with single-file transfers. streams is the number of streams sharing the connection
+    connection_type = 'TLS' if use_tls else 'TCP'
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_entry = f"{timestamp},{connection_type},{data_size},{duration:.6f},{streams}"
+    if memory_usage:
+        log_entry += f",{memory_usage['peak_traced']},{memory_usage['rss']}"
+    log_entry += "\n"
+    try:
+        with open(MULTIPLEX_LOG_FILE, 'a') as log_file:
+            log_file.write(log_entry)
+    except IOError as e:
+        print(f"Failed to write log entry: {e}")
+
+def log_dedup_performance(data_size, bytes_sent, duration, chunking_time, hit_rate, use_tls, memory_usage=None):
+    # Deduplicated transfers get their own CSV so they don't skew the TCP vs TLS comparison. duration
+    # includes chunking_time; data_size is the file size, bytes_sent only the chunks that were missing
+    connection_type = 'TLS' if use_tls else 'TCP'
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_entry = (f"{timestamp},{connection_type},{data_size},{bytes_sent},{duration:.6f},"
+                 f"{chunking_time:.6f},{hit_rate:.4f}")
+    if memory_usage:
+        log_entry += f",{memory_usage['peak_traced']},{memory_usage['rss']}"
+    log_entry += "\n"
+    try:
+        with open(DEDUP_LOG_FILE, 'a') as log_file:
+            log_file.write(log_entry)
+    except IOError as e:
+        print(f"Failed to write log entry: {e}")
+
 class Client:
-    def __init__(self, host, port, use_tls):
+    def __init__(self, host, port, use_tls, tracer=None, memory=None):
         self.host = host
         self.port = port
         self.use_tls = use_tls
+        self.tracer = tracer or NULL_TRACER
+        self.memory = memory or NULL_MONITOR
         self.stats = {'data_size': 0,
                       'transfer_time': 0.0,
                       'average_speed': 0.0,
+                      'peak_memory': 0,
+                      'bytes_sent': 0,
+                      'dedup_hit_rate': 0.0,
+                      'chunking_time': 0.0,
+                      'acknowledged': False,
                       'connection_type': 'TLS' if use_tls else 'TCP',
                       'timestamp': '',}
     
@@ -39,9 +88,14 @@ class Client:
                 if DEBUG:
                     context.check_hostname = False
                     context.verify_mode = ssl.CERT_NONE # Disable certificate verification for debugging to accept self-signed certs
-                self.sock = context.wrap_socket(self.sock, server_hostname=self.host)
+                # Handshake explicitly after connect so it shows up as its own span
+                self.sock = context.wrap_socket(self.sock, server_hostname=self.host, do_handshake_on_connect=False)
 
-            self.sock.connect((self.host, self.port))
+            with self.tracer.span('connect'):
+                self.sock.connect((self.host, self.port))
+            if self.use_tls:
+                with self.tracer.span('tls_handshake'):
+                    self.sock.do_handshake()
             print(f"Connected to server {self.host}:{self.port} {'with TLS' if self.use_tls else 'without TLS'}.")
             if self.use_tls:
                 print(f"Server certificate:\n{self.sock.getpeercert()}")
@@ -60,55 +114,264 @@ class Client:
             print("No connection established.")
             return
 
+        memory_usage = self.memory.begin()
         try:
             with open(file_path, 'rb') as file:
-                data = file.read()
+                with self.tracer.span('file_read'):
+                    data = file.read()
                 data_size = len(data)
                 
                 # Send file size header
                 size_header = data_size.to_bytes(8, byteorder='big')
-                self.sock.sendall(size_header)
+                with self.tracer.span('header_send'):
+                    self.sock.sendall(size_header)
                 
                 # Measure only the data transfer time (not ACK reception)
-                start_time = time.time()
-                self.sock.sendall(data)
-                end_time = time.time()
+                with self.tracer.span('send', bytes=data_size):
+                    start_time = time.time()
+                    self.sock.sendall(data)
+                    end_time = time.time()
                 
                 # Wait for acknowledgment (but don't include in timing)
-                ack = self.sock.recv(1024)
+                with self.tracer.span('ack_recv'):
+                    ack = self.sock.recv(1024)
                 
-                if ack:
-                    ack_decoded = ack.decode('utf-8')
-                    print(f"Server acknowledged: {ack_decoded}")
+                if not ack:
+                    print("Server closed the connection without acknowledging the file.")
+                    return
+                ack_decoded = ack.decode('utf-8')
+                print(f"Server acknowledged: {ack_decoded}")
                 
                 duration = end_time - start_time
                 average_speed = data_size / duration if duration > 0 else 0
+                memory_usage = self.memory.end(memory_usage)
 
                 # Update stats
                 self.stats['data_size'] = data_size
                 self.stats['transfer_time'] = duration
                 self.stats['average_speed'] = average_speed
+                self.stats['acknowledged'] = True
                 self.stats['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                if memory_usage:
+                    self.stats['peak_memory'] = memory_usage['peak_traced']
 
                 print(f"Sent {data_size} bytes in {duration:.6f} seconds. Average speed: {average_speed:.2f} bytes/second.")
 
                 # Log performance
-                log_performance(data_size, duration, self.use_tls)
+                log_performance(data_size, duration, self.use_tls, memory_usage)
+
+        except IOError as e:
+            print(f"Failed to read/send file: {e}")
+        finally:
+            self.sock.close()
+            self.memory.end(memory_usage)
+
+    def send_files_multiplexed(self, file_paths):
+        # Interleave uploads of several files over the single connection, round-robin between
+        # the streams that still have flow-control window left
+        if not self.sock:
+            print("No connection established.")
+            return
+
+        streams = {}
+        memory_usage = self.memory.begin()
+        try:
+            reader = FrameReader(self.sock)
+            self.sock.sendall(MUX_MAGIC)
+            for stream_id, file_path in enumerate(file_paths, start=1):
+                file = open(file_path, 'rb')
+                data_size = os.fstat(file.fileno()).st_size
+                streams[stream_id] = {'file': file,
+                                      'path': file_path,
+                                      'data_size': data_size,
+                                      'remaining': data_size,
+                                      'window': INITIAL_WINDOW,
+                                      'start_time': time.time(),
+                                      'duration': None,
+                                      'acked': False,}
+                open_payload = data_size.to_bytes(8, byteorder='big') + os.path.basename(file_path).encode('utf-8')
+                self.sock.sendall(pack_frame(stream_id, FRAME_OPEN, open_payload))
+
+            frame_index = 0
+            while not all(stream['acked'] for stream in streams.values()):
+                progressed = False
+                for stream_id, stream in streams.items():
+                    if stream['duration'] is not None or stream['window'] == 0:
+                        continue
+                    chunk = stream['file'].read(min(MAX_FRAME_SIZE, stream['window'], stream['remaining']))
+                    if chunk:
+                        with self.tracer.chunk_span('send_frame', frame_index, stream=stream_id, bytes=len(chunk)):
+                            self.sock.sendall(pack_frame(stream_id, FRAME_DATA, chunk))
+                        frame_index += 1
+                        stream['window'] -= len(chunk)
+                        stream['remaining'] -= len(chunk)
+                        progressed = True
+                    if stream['remaining'] == 0:
+                        self.sock.sendall(pack_frame(stream_id, FRAME_END))
+                        # Same as send_file, the timing excludes the acknowledgment
+                        stream['duration'] = time.time() - stream['start_time']
+                        stream['file'].close()
+                        progressed = True
+
+                # Only poll for control frames while streams make progress, block when none can
+                frame = reader.read_frame(block=not progressed)
+                if frame is None and not reader.closed:
+                    continue
+                if frame is None:
+                    print("Server closed the connection before acknowledging every stream.")
+                    break
+                stream_id, frame_type, payload = frame
+                if stream_id not in streams:
+                    raise ProtocolError(f"Frame for unknown stream {stream_id}")
+                if frame_type == FRAME_WINDOW:
+                    streams[stream_id]['window'] += int.from_bytes(payload, byteorder='big')
+                elif frame_type == FRAME_ACK:
+                    streams[stream_id]['acked'] = True
+                    print(f"Server acknowledged stream {stream_id}: {payload.decode('utf-8')}")
+                else:
+                    raise ProtocolError(f"Unexpected frame type {frame_type} on stream {stream_id}")
+
+            # Streams share the connection, so each one is logged with the connection's peak.
+            # Only acknowledged streams count as transferred
+            memory_usage = self.memory.end(memory_usage)
+            for stream in streams.values():
+                if not stream['acked']:
+                    continue
+                duration = stream['duration']
+                average_speed = stream['data_size'] / duration if duration > 0 else 0
+                print(f"Sent {stream['data_size']} bytes of '{stream['path']}' in {duration:.6f} seconds. "
+                      f"Average speed: {average_speed:.2f} bytes/second.")
+                log_multiplexed_performance(stream['data_size'], duration, len(streams), self.use_tls, memory_usage)
+
+            # Stats cover all streams of the connection
+            total_size = sum(stream['data_size'] for stream in streams.values())
+            total_time = max((stream['duration'] or 0.0 for stream in streams.values()), default=0.0)
+            self.stats['data_size'] = total_size
+            self.stats['transfer_time'] = total_time
+            self.stats['average_speed'] = total_size / total_time if total_time > 0 else 0
+            self.stats['acknowledged'] = all(stream['acked'] for stream in streams.values())
+            self.stats['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if memory_usage:
+                self.stats['peak_memory'] = memory_usage['peak_traced']
+
+        except (IOError, ProtocolError) as e:
+            print(f"Failed to send multiplexed files: {e}")
+        finally:
+            for stream in streams.values():
+                stream['file'].close()
+            self.sock.close()
+            self.memory.end(memory_usage)
+
+    def send_file_dedup(self, file_path):
+        # Send the file's chunk digests first, then only the chunks the server doesn't have yet
+        if not self.sock:
+            print("No connection established.")
+            return
+
+        memory_usage = self.memory.begin()
+        try:
+            with open(file_path, 'rb') as file:
+                with self.tracer.span('file_read'):
+                    data = file.read()
+            data_size = len(data)
+            # Chunking is part of what a deduplicated transfer costs, so the timing starts before it
+            start_time = time.time()
+            with self.tracer.span('chunking', bytes=data_size):
+                chunks = split_chunks(data)
+            chunking_time = time.time() - start_time
+            chunk_map = dict(chunks)
+
+            header = DEDUP_MAGIC + data_size.to_bytes(8, byteorder='big') + len(chunks).to_bytes(4, byteorder='big')
+            with self.tracer.span('digest_send', chunks=len(chunks)):
+                self.sock.sendall(header + b''.join(digest for digest, _ in chunks))
+
+            with self.tracer.span('missing_recv'):
+                count_data = recv_exact(self.sock, 4)
+                missing_data = recv_exact(self.sock, int.from_bytes(count_data, byteorder='big') * DIGEST_SIZE) if count_data else None
+            if missing_data is None:
+                print("Server closed the connection before listing the missing chunks.")
+                return
+            missing = [missing_data[i:i + DIGEST_SIZE] for i in range(0, len(missing_data), DIGEST_SIZE)]
+
+            bytes_sent = 0
+            with self.tracer.span('send', chunks=len(missing)):
+                for digest in missing:
+                    chunk = chunk_map[digest]
+                    self.sock.sendall(len(chunk).to_bytes(4, byteorder='big'))
+                    self.sock.sendall(chunk)
+                    bytes_sent += len(chunk)
+            end_time = time.time()
+
+            # Wait for acknowledgment (but don't include in timing)
+            with self.tracer.span('ack_recv'):
+                ack = self.sock.recv(1024)
+            if not ack:
+                print("Server closed the connection without acknowledging the file.")
+                return
+            print(f"Server acknowledged: {ack.decode('utf-8')}")
+
+            duration = end_time - start_time
+            average_speed = data_size / duration if duration > 0 else 0
+            hit_rate = 1 - len(missing) / len(chunk_map) if chunk_map else 0.0
+            memory_usage = self.memory.end(memory_usage)
+
+            # Update stats
+            self.stats['data_size'] = data_size
+            self.stats['transfer_time'] = duration
+            self.stats['average_speed'] = average_speed
+            self.stats['bytes_sent'] = bytes_sent
+            self.stats['dedup_hit_rate'] = hit_rate
+            self.stats['chunking_time'] = chunking_time
+            self.stats['acknowledged'] = True
+            self.stats['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if memory_usage:
+                self.stats['peak_memory'] = memory_usage['peak_traced']
+
+            print(f"Sent {data_size} bytes in {duration:.6f} seconds, {chunking_time:.6f} of them chunking "
+                  f"({bytes_sent} over the wire, {hit_rate * 100:.1f}% of chunks deduplicated). "
+                  f"Average speed: {average_speed:.2f} bytes/second.")
+
+            # Log performance
+            log_dedup_performance(data_size, bytes_sent, duration, chunking_time, hit_rate, self.use_tls, memory_usage)
 
         except IOError as e:
             print(f"Failed to read/send file: {e}")
         finally:
             self.sock.close()
+            self.memory.end(memory_usage)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Send a file to the server with optional TLS.')
-    parser.add_argument('file', help='Path to the file to be sent.')
+    parser.add_argument('file', nargs='+', help='Path to the file(s) to be sent.')
     parser.add_argument('--tls', action='store_true', help='Enable TLS for the client.') # Add argument to enable TLS
     parser.add_argument('--port', type=int, default=65432, help='Port number to connect to the server.')
+    parser.add_argument('--multiplex', action='store_true', help='Send all files concurrently over a single connection.')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Only send the chunks of the file the server does not already have. Chunking is CPU bound '
+                             '(around 100 MB/s with numpy, a few MB/s without), so this only pays off on links slower '
+                             'than that or when most chunks are already on the server.')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace-event JSON of transfer spans to FILE.')
+    parser.add_argument('--trace-sample', type=int, default=64, help='Record one in every N per-chunk send spans when tracing.')
+    parser.add_argument('--memory', action='store_true', help='Log peak traced memory and RSS next to the timings.')
     args = parser.parse_args()
+    if len(args.file) > 1 and not args.multiplex:
+        parser.error('sending several files requires --multiplex')
+    if args.multiplex and args.dedup:
+        parser.error('--dedup can not be combined with --multiplex')
 
-    client = Client(HOST, args.port, args.tls)
+    tracer = Tracer(enabled=True, sample_every=args.trace_sample) if args.trace else None
+    memory = MemoryMonitor(enabled=True) if args.memory else None
+    client = Client(HOST, args.port, args.tls, tracer, memory)
     client.connect()
-    client.send_file(args.file)
+    if args.multiplex:
+        client.send_files_multiplexed(args.file)
+    elif args.dedup:
+        client.send_file_dedup(args.file[0])
+    else:
+        client.send_file(args.file[0])
+    if tracer:
+        tracer.save(args.trace)
+    if memory:
+        memory.stop()
     print("File transfer completed.")
\ No newline at end of file
@@ -1,13 +1,31 @@
 # Receive csv data from server to analyze performance using TLS vs non-TLS (TCP)
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+# pandas and matplotlib are imported lazily so that importing this module (e.g. from
+# run_performance_tests.py) doesn't pay their startup cost when no graphs are drawn.
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+GRAPH_DPI = 300
+
+def _pandas():
+    import pandas as pd
+    return pd
+
+def _pyplot():
+    # Force the headless Agg backend before pyplot is imported (also in worker processes)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def load_performance_data(file_path):
+    pd = _pandas()
     try:
-        data = pd.read_csv(file_path, names=['timestamp', 'connection_type', 'data_size', 'duration'])
+        # peak_memory/rss are only present for runs with memory instrumentation enabled
+        data = pd.read_csv(file_path, names=['timestamp', 'connection_type', 'data_size', 'duration',
+                                             'peak_memory', 'rss'])
         data['data_size'] = data['data_size'].astype(int)
         data['duration'] = data['duration'].astype(float)
+        data['data_size_mb'] = data['data_size'] / (1024 * 1024)
         # Convert duration to milliseconds
         data['duration_ms'] = data['duration'] * 1000
         # Calculate speed in MB/s
@@ -21,6 +39,7 @@ def analyze_performance(data):
     if data is None or data.empty:
         print("No data to analyze.")
         return
+    pd = _pandas()
 
     summary = data.groupby('connection_type').agg(
         count=pd.NamedAgg(column='duration', aggfunc='count'),
@@ -56,6 +75,7 @@ def create_graph(data):
     if data is None or data.empty:
         print("No data to create graph.")
         return
+    plt = _pyplot()
 
     # Separate data by connection type
     tls_data = data[data['connection_type'] == 'TLS']
@@ -118,28 +138,24 @@ def create_graph(data):
         axes[2].legend()
     
     plt.tight_layout()
-    plt.savefig('graph_performance_comparison.png', dpi=300, bbox_inches='tight')
+    plt.savefig('graph_performance_comparison.png', dpi=GRAPH_DPI, bbox_inches='tight')
     plt.close()
     print("Saved: graph_performance_comparison.png")
 
-if __name__ == "__main__":
-    performance_data = load_performance_data('client_performance.log')
-    analyze_performance(performance_data)
-    create_graph(performance_data)
-    print("Performance analysis and graph generation completed.")
-    
-    print("\nAll graphs saved successfully!")
+def _size_columns(summary, column, names):
+    # Select the pre-aggregated mean/std of column from a per-size summary, renamed to names
+    selected = summary[['data_size_mb', f'{column}_mean', f'{column}_std']].copy()
+    selected.columns = names
+    return selected
 
-def create_time_graph(tls_data, tcp_data):
+def create_time_graph(tls_summary, tcp_summary):
     """Graph 1: Transfer Time Comparison"""
+    plt = _pyplot()
     fig, axes = plt.subplots(1, 3, figsize=(18, 5))
     
     # TLS Time
-    if not tls_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean', 'std']
+    if not tls_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'duration_ms', ['data_size_mb', 'mean', 'std'])
         
         axes[0].plot(grouped_tls['data_size_mb'], grouped_tls['mean'], 
                      marker='o', color='#2E86AB', linewidth=2, markersize=8)
@@ -157,11 +173,8 @@ def create_time_graph(tls_data, tcp_data):
                      ha='center', va='center', transform=axes[0].transAxes)
     
     # TCP Time
-    if not tcp_data.empty:
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean', 'std']
+    if not tcp_summary.empty:
+        grouped_tcp = _size_columns(tcp_summary, 'duration_ms', ['data_size_mb', 'mean', 'std'])
         
         axes[1].plot(grouped_tcp['data_size_mb'], grouped_tcp['mean'], 
                      marker='s', color='#A23B72', linewidth=2, markersize=8)
@@ -179,16 +192,10 @@ def create_time_graph(tls_data, tcp_data):
                      ha='center', va='center', transform=axes[1].transAxes)
     
     # Comparison
-    if not tls_data.empty and not tcp_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean_tls', 'std_tls']
+    if not tls_summary.empty and not tcp_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'duration_ms', ['data_size_mb', 'mean_tls', 'std_tls'])
         
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean_tcp', 'std_tcp']
+        grouped_tcp = _size_columns(tcp_summary, 'duration_ms', ['data_size_mb', 'mean_tcp', 'std_tcp'])
         
         axes[2].plot(grouped_tls['data_size_mb'], grouped_tls['mean_tls'], 
                      marker='o', label='TLS', color='#2E86AB', linewidth=2, markersize=8)
@@ -204,11 +211,8 @@ def create_time_graph(tls_data, tcp_data):
                              grouped_tcp['mean_tcp'] + grouped_tcp['std_tcp'],
                              alpha=0.2, color='#A23B72')
         axes[2].legend(fontsize=11)
-    elif not tls_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean', 'std']
+    elif not tls_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'duration_ms', ['data_size_mb', 'mean', 'std'])
         
         axes[2].plot(grouped_tls['data_size_mb'], grouped_tls['mean'], 
                      marker='o', label='TLS', color='#2E86AB', linewidth=2, markersize=8)
@@ -217,11 +221,8 @@ def create_time_graph(tls_data, tcp_data):
                              grouped_tls['mean'] + grouped_tls['std'],
                              alpha=0.3, color='#2E86AB')
         axes[2].legend(fontsize=11)
-    elif not tcp_data.empty:
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'duration_ms': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean', 'std']
+    elif not tcp_summary.empty:
+        grouped_tcp = _size_columns(tcp_summary, 'duration_ms', ['data_size_mb', 'mean', 'std'])
         
         axes[2].plot(grouped_tcp['data_size_mb'], grouped_tcp['mean'], 
                      marker='s', label='TCP', color='#A23B72', linewidth=2, markersize=8)
@@ -234,26 +235,24 @@ def create_time_graph(tls_data, tcp_data):
     axes[2].set_xlabel('File Size (MB)', fontsize=11)
     axes[2].set_ylabel('Transfer Time (milliseconds)', fontsize=11)
     axes[2].set_title('TLS vs TCP - Transfer Time', fontsize=13, fontweight='bold')
-    if not tls_data.empty:
-        sizes = sorted(tls_data['data_size_mb'].unique())
+    if not tls_summary.empty:
+        sizes = tls_summary['data_size_mb']
         axes[2].set_xticks(sizes)
         axes[2].set_xticklabels([f'{int(x)}' for x in sizes])
     
     plt.tight_layout()
-    plt.savefig('graph_transfer_time.png', dpi=300, bbox_inches='tight')
+    plt.savefig('graph_transfer_time.png', dpi=GRAPH_DPI, bbox_inches='tight')
     plt.close()
     print("Saved: graph_transfer_time.png")
 
-def create_speed_graph(tls_data, tcp_data):
+def create_speed_graph(tls_summary, tcp_summary):
     """Graph 2: Transfer Speed Comparison"""
+    plt = _pyplot()
     fig, axes = plt.subplots(1, 3, figsize=(18, 5))
     
     # TLS Speed
-    if not tls_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean', 'std']
+    if not tls_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'speed_mbps', ['data_size_mb', 'mean', 'std'])
         
         axes[0].plot(grouped_tls['data_size_mb'], grouped_tls['mean'], 
                      marker='o', color='#2E86AB', linewidth=2, markersize=8)
@@ -271,11 +270,8 @@ def create_speed_graph(tls_data, tcp_data):
                      ha='center', va='center', transform=axes[0].transAxes)
     
     # TCP Speed
-    if not tcp_data.empty:
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean', 'std']
+    if not tcp_summary.empty:
+        grouped_tcp = _size_columns(tcp_summary, 'speed_mbps', ['data_size_mb', 'mean', 'std'])
         
         axes[1].plot(grouped_tcp['data_size_mb'], grouped_tcp['mean'], 
                      marker='s', color='#A23B72', linewidth=2, markersize=8)
@@ -293,16 +289,10 @@ def create_speed_graph(tls_data, tcp_data):
                      ha='center', va='center', transform=axes[1].transAxes)
     
     # Comparison
-    if not tls_data.empty and not tcp_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean_tls', 'std_tls']
+    if not tls_summary.empty and not tcp_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'speed_mbps', ['data_size_mb', 'mean_tls', 'std_tls'])
         
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean_tcp', 'std_tcp']
+        grouped_tcp = _size_columns(tcp_summary, 'speed_mbps', ['data_size_mb', 'mean_tcp', 'std_tcp'])
         
         axes[2].plot(grouped_tls['data_size_mb'], grouped_tls['mean_tls'], 
                      marker='o', label='TLS', color='#2E86AB', linewidth=2, markersize=8)
@@ -318,11 +308,8 @@ def create_speed_graph(tls_data, tcp_data):
                              grouped_tcp['mean_tcp'] + grouped_tcp['std_tcp'],
                              alpha=0.2, color='#A23B72')
         axes[2].legend(fontsize=11)
-    elif not tls_data.empty:
-        grouped_tls = tls_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tls.columns = ['data_size_mb', 'mean', 'std']
+    elif not tls_summary.empty:
+        grouped_tls = _size_columns(tls_summary, 'speed_mbps', ['data_size_mb', 'mean', 'std'])
         
         axes[2].plot(grouped_tls['data_size_mb'], grouped_tls['mean'], 
                      marker='o', label='TLS', color='#2E86AB', linewidth=2, markersize=8)
@@ -331,11 +318,8 @@ def create_speed_graph(tls_data, tcp_data):
                              grouped_tls['mean'] + grouped_tls['std'],
                              alpha=0.3, color='#2E86AB')
         axes[2].legend(fontsize=11)
-    elif not tcp_data.empty:
-        grouped_tcp = tcp_data.groupby('data_size_mb').agg({
-            'speed_mbps': ['mean', 'std']
-        }).reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'mean', 'std']
+    elif not tcp_summary.empty:
+        grouped_tcp = _size_columns(tcp_summary, 'speed_mbps', ['data_size_mb', 'mean', 'std'])
         
         axes[2].plot(grouped_tcp['data_size_mb'], grouped_tcp['mean'], 
                      marker='s', label='TCP', color='#A23B72', linewidth=2, markersize=8)
@@ -348,33 +332,34 @@ def create_speed_graph(tls_data, tcp_data):
     axes[2].set_xlabel('File Size (MB)', fontsize=11)
     axes[2].set_ylabel('Transfer Speed (MB/s)', fontsize=11)
     axes[2].set_title('TLS vs TCP - Transfer Speed', fontsize=13, fontweight='bold')
-    if not tls_data.empty:
-        sizes = sorted(tls_data['data_size_mb'].unique())
+    if not tls_summary.empty:
+        sizes = tls_summary['data_size_mb']
         axes[2].set_xticks(sizes)
         axes[2].set_xticklabels([f'{int(x)}' for x in sizes])
     
     plt.tight_layout()
-    plt.savefig('graph_transfer_speed.png', dpi=300, bbox_inches='tight')
+    plt.savefig('graph_transfer_speed.png', dpi=GRAPH_DPI, bbox_inches='tight')
     plt.close()
     print("Saved: graph_transfer_speed.png")
 
-def create_comparison_graph(tls_data, tcp_data):
+def create_comparison_graph(tls_summary, tcp_summary, speed_means):
     """Graph 3: Performance Comparison Overview"""
+    plt = _pyplot()
     fig, axes = plt.subplots(1, 2, figsize=(14, 5))
     
     # Bar chart: Average Speed
-    if not tls_data.empty or not tcp_data.empty:
+    if not tls_summary.empty or not tcp_summary.empty:
         speeds = []
         labels = []
         colors = []
         
-        if not tls_data.empty:
-            speeds.append(tls_data['speed_mbps'].mean())
+        if not tls_summary.empty:
+            speeds.append(speed_means['TLS'])
             labels.append('TLS')
             colors.append('#2E86AB')
         
-        if not tcp_data.empty:
-            speeds.append(tcp_data['speed_mbps'].mean())
+        if not tcp_summary.empty:
+            speeds.append(speed_means['TCP'])
             labels.append('TCP')
             colors.append('#A23B72')
         
@@ -388,13 +373,11 @@ def create_comparison_graph(tls_data, tcp_data):
                         ha='center', va='bottom', fontweight='bold')
     
     # Performance overhead percentage
-    if not tls_data.empty and not tcp_data.empty:
+    if not tls_summary.empty and not tcp_summary.empty:
         # Calculate overhead for each file size
-        grouped_tcp = tcp_data.groupby('data_size_mb')['duration_ms'].mean().reset_index()
-        grouped_tcp.columns = ['data_size_mb', 'duration_tcp']
+        grouped_tcp = tcp_summary[['data_size_mb', 'duration_ms_mean']].rename(columns={'duration_ms_mean': 'duration_tcp'})
         
-        grouped_tls = tls_data.groupby('data_size_mb')['duration_ms'].mean().reset_index()
-        grouped_tls.columns = ['data_size_mb', 'duration_tls']
+        grouped_tls = tls_summary[['data_size_mb', 'duration_ms_mean']].rename(columns={'duration_ms_mean': 'duration_tls'})
         
         merged = grouped_tcp.merge(grouped_tls, on='data_size_mb')
         merged['overhead_pct'] = ((merged['duration_tls'] - merged['duration_tcp']) / 
@@ -413,12 +396,134 @@ def create_comparison_graph(tls_data, tcp_data):
                     ha='center', va='center', transform=axes[1].transAxes)
     
     plt.tight_layout()
-    plt.savefig('graph_performance_comparison.png', dpi=300, bbox_inches='tight')
+    plt.savefig('graph_performance_overview.png', dpi=GRAPH_DPI, bbox_inches='tight')
     plt.close()
-    print("Saved: graph_performance_comparison.png")
+    print("Saved: graph_performance_overview.png")
+
+def load_memory_data(file_path):
+    # Per-connection memory log written by the server with --memory
+    if not os.path.exists(file_path):
+        return None
+    pd = _pandas()
+    try:
+        data = pd.read_csv(file_path, names=['timestamp', 'connection_type', 'protocol', 'data_size',
+                                             'duration', 'peak_memory', 'rss', 'concurrency'])
+        data['data_size_mb'] = data['data_size'] / (1024 * 1024)
+        data['peak_memory_mb'] = data['peak_memory'] / (1024 * 1024)
+        return data
+    except Exception as e:
+        print(f"Error loading memory data from {file_path}: {e}")
+        return None
+
+def load_rss_samples(file_path):
+    # RSS samples written by the server with --memory on shutdown
+    if not os.path.exists(file_path):
+        return None
+    pd = _pandas()
+    try:
+        samples = pd.read_csv(file_path, names=['elapsed', 'rss', 'active'])
+        samples['rss_mb'] = samples['rss'] / (1024 * 1024)
+        return samples
+    except Exception as e:
+        print(f"Error loading RSS samples from {file_path}: {e}")
+        return None
+
+def create_memory_graph(memory_data, rss_samples):
+    """Graph 4: Memory Usage by Payload Size and Concurrency"""
+    plt = _pyplot()
+    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+    colors = {'TLS': '#2E86AB', 'TCP': '#A23B72'}
+
+    # Peak traced memory per connection against payload size
+    for connection_type, group in memory_data.groupby('connection_type'):
+        axes[0].scatter(group['data_size_mb'], group['peak_memory_mb'], label=connection_type,
+                        color=colors.get(connection_type), alpha=0.7)
+    axes[0].set_xlabel('File Size (MB)', fontsize=11)
+    axes[0].set_ylabel('Peak Traced Memory (MB)', fontsize=11)
+    axes[0].set_title('Peak Memory per Connection', fontsize=13, fontweight='bold')
+    axes[0].legend()
+
+    # Mean peak traced memory against the number of concurrent connections
+    grouped = memory_data.groupby(['connection_type', 'concurrency'])['peak_memory_mb'].mean().reset_index()
+    for connection_type, group in grouped.groupby('connection_type'):
+        axes[1].plot(group['concurrency'], group['peak_memory_mb'], marker='o', label=connection_type,
+                     color=colors.get(connection_type), linewidth=2, markersize=8)
+    axes[1].set_xlabel('Concurrent Connections', fontsize=11)
+    axes[1].set_ylabel('Mean Peak Traced Memory (MB)', fontsize=11)
+    axes[1].set_title('Peak Memory by Concurrency', fontsize=13, fontweight='bold')
+    axes[1].legend()
+
+    # Process RSS over the whole run
+    if rss_samples is not None and not rss_samples.empty:
+        axes[2].plot(rss_samples['elapsed'], rss_samples['rss_mb'], color='#F18F01', linewidth=1.5)
+        axes[2].set_xlabel('Elapsed Time (s)', fontsize=11)
+        axes[2].set_ylabel('RSS (MB)', fontsize=11)
+    else:
+        axes[2].text(0.5, 0.5, 'No RSS samples available',
+                     ha='center', va='center', transform=axes[2].transAxes)
+    axes[2].set_title('Server RSS Over Time', fontsize=13, fontweight='bold')
+
+    plt.tight_layout()
+    plt.savefig('graph_memory_usage.png', dpi=GRAPH_DPI, bbox_inches='tight')
+    plt.close()
+    print("Saved: graph_memory_usage.png")
+
+def summarize_by_size(data):
+    """Mean and std of transfer time and speed per file size, aggregated once for all graphs"""
+    summary = data.groupby('data_size_mb').agg(
+        duration_ms_mean=('duration_ms', 'mean'),
+        duration_ms_std=('duration_ms', 'std'),
+        speed_mbps_mean=('speed_mbps', 'mean'),
+        speed_mbps_std=('speed_mbps', 'std'),
+    ).reset_index()
+    return summary
+
+def prepare_graph_data(data):
+    """Split the dataset once and pre-aggregate the per-size tables shared by every graph"""
+    columns = ['connection_type', 'data_size_mb', 'duration_ms', 'speed_mbps']
+    data = data[columns]
+    tls_data = data[data['connection_type'] == 'TLS']
+    tcp_data = data[data['connection_type'] == 'TCP']
+    speed_means = {'TLS': tls_data['speed_mbps'].mean(), 'TCP': tcp_data['speed_mbps'].mean()}
+    return data, summarize_by_size(tls_data), summarize_by_size(tcp_data), speed_means
+
+def render_all_graphs(data, max_workers=None, memory_data=None, rss_samples=None):
+    """Render every graph from one prepared dataset, each figure in its own process"""
+    if data is None or data.empty:
+        print("No data to create graph.")
+        return
+
+    data, tls_summary, tcp_summary, speed_means = prepare_graph_data(data)
+    jobs = [
+        (create_graph, (data,)),
+        (create_time_graph, (tls_summary, tcp_summary)),
+        (create_speed_graph, (tls_summary, tcp_summary)),
+        (create_comparison_graph, (tls_summary, tcp_summary, speed_means)),
+    ]
+    if memory_data is not None and not memory_data.empty:
+        jobs.append((create_memory_graph, (memory_data, rss_samples)))
+
+    if max_workers is None:
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+    if max_workers <= 1:
+        for func, args in jobs:
+            func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *args) for func, args in jobs]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to render graph: {e}")
 
 if __name__ == "__main__":
     performance_data = load_performance_data('client_performance.log')
     analyze_performance(performance_data)
-    create_graph(performance_data)
+    render_all_graphs(performance_data,
+                      memory_data=load_memory_data('server_memory.log'),
+                      rss_samples=load_rss_samples('server_rss_samples.log'))
     print("Performance analysis and graph generation completed.")
+    
+    print("\nAll graphs saved successfully!")
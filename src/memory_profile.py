@@ -0,0 +1,119 @@
+# Opt-in memory accounting of transfers: peak traced allocations per connection (tracemalloc)
+# and a background sampler of the process RSS over time.
+import os
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+RSS_SAMPLE_INTERVAL = 0.05 # seconds
+
+def current_rss():
+    # Resident set size of this process in bytes
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        pass
+    try:
+        # Not available on /proc-less systems, fall back to the peak RSS (KB on Linux, bytes on macOS)
+        import resource
+        import sys
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+    except ImportError:
+        return 0
+
+class MemoryMonitor:
+    def __init__(self, enabled=False, samples_file=None, sample_interval=RSS_SAMPLE_INTERVAL):
+        # With samples_file, a background sampler appends the RSS to it as CSV while the monitor
+        # runs; samples go straight to the file so a long-running server doesn't accumulate them
+        self.enabled = enabled
+        self.samples_file = samples_file
+        self.sample_interval = sample_interval
+        self.sample_count = 0
+        self.active = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not self.samples_file or self.sampler:
+            return
+        try:
+            samples_file = open(self.samples_file, 'w', buffering=1)
+        except IOError as e:
+            print(f"Failed to open RSS samples file {self.samples_file}: {e}")
+            return
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self._sample_rss, args=(samples_file,), name='rss-sampler',
+                                        daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        if not self.sampler:
+            return
+        self.stop_event.set()
+        self.sampler.join()
+        self.sampler = None
+        print(f"Saved {self.sample_count} RSS samples to {self.samples_file}")
+
+    def _sample_rss(self, samples_file):
+        start_time = time.time()
+        with samples_file:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    active = self.active
+                try:
+                    samples_file.write(f"{time.time() - start_time:.3f},{current_rss()},{active}\n")
+                    self.sample_count += 1
+                except IOError as e:
+                    print(f"Failed to write RSS sample to {self.samples_file}: {e}")
+                    return
+                self.stop_event.wait(self.sample_interval)
+
+    def begin(self):
+        # Start accounting one connection, returns the token to pass to end()
+        if not self.enabled:
+            return None
+        self.start()
+        with self.lock:
+            # tracemalloc only has a process-wide peak: reset it when no other connection is
+            # in flight, otherwise the recorded peak also covers the overlapping connections
+            if self.active == 0:
+                tracemalloc.reset_peak()
+            self.active += 1
+            concurrency = self.active
+        current, _ = tracemalloc.get_traced_memory()
+        return {'start_traced': current, 'concurrency': concurrency}
+
+    def end(self, usage):
+        # Returns the usage dict completed with the connection's peak traced bytes and current RSS
+        if usage is None or 'peak_traced' in usage:
+            return usage # Disabled, or already ended
+        _, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            self.active -= 1
+        usage['peak_traced'] = max(0, peak - usage['start_traced'])
+        usage['rss'] = current_rss()
+        return usage
+
+def log_memory_usage(file_path, connection_type, protocol, data_size, duration, usage):
+    # Log one connection's memory usage next to its timing, as CSV. protocol is the transfer mode
+    # (single, multiplex or dedup), data_size the size of the transferred payload, and concurrency
+    # the number of connections in flight (including this one) when it started
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_entry = (f"{timestamp},{connection_type},{protocol},{data_size},{duration:.6f},"
+                 f"{usage['peak_traced']},{usage['rss']},{usage['concurrency']}\n")
+    try:
+        with open(file_path, 'a') as log_file:
+            log_file.write(log_entry)
+    except IOError as e:
+        print(f"Failed to write memory log entry: {e}")
+
+# Default monitor used when none is passed in; disabled, so begin()/end() do nothing
+NULL_MONITOR = MemoryMonitor(enabled=False)
@@ -0,0 +1,97 @@
+# Framed protocol used to multiplex many concurrent file streams over a single (TLS) connection.
+# The client opens the connection with MUX_MAGIC in place of the 8-byte size header of the
+# single-file protocol, so the server can tell both modes apart on the same port.
+# Every frame is: stream ID (4 bytes), frame type (1 byte), payload length (4 bytes), payload.
+import ssl
+import struct
+
+MUX_MAGIC = b'SEGMUX01'
+FRAME_HEADER = struct.Struct('!IBI')
+
+# Client -> server
+FRAME_OPEN = 1    # payload: 8-byte file size followed by the UTF-8 file name
+FRAME_DATA = 2    # payload: file bytes, never more than the stream's remaining window
+FRAME_END = 3     # empty payload, all of the stream's data has been sent
+# Server -> client
+FRAME_WINDOW = 4  # payload: 4-byte window increment for the stream
+FRAME_ACK = 5     # payload: UTF-8 acknowledgment message, the stream is closed
+
+MAX_FRAME_SIZE = 64 * 1024
+INITIAL_WINDOW = 256 * 1024 # Per-stream flow-control window, in bytes
+RECV_SIZE = 64 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+def pack_frame(stream_id, frame_type, payload=b''):
+    return FRAME_HEADER.pack(stream_id, frame_type, len(payload)) + payload
+
+def recv_exact(sock, size):
+    # Receive exactly size bytes, returns None if the connection was closed before that
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def read_frame(sock):
+    # Returns (stream_id, frame_type, payload), or None if the connection was closed
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    stream_id, frame_type, length = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    payload = recv_exact(sock, length) if length else b''
+    if payload is None:
+        return None
+    return stream_id, frame_type, payload
+
+class FrameReader:
+    # Buffers received bytes so frames can be polled without blocking: readability of the socket
+    # doesn't mean a frame is there (over TLS it may only be a session ticket), and a frame may
+    # arrive in several pieces
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.closed = False
+
+    def _next_buffered(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        stream_id, frame_type, length = FRAME_HEADER.unpack_from(self.buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        end = FRAME_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
+        return stream_id, frame_type, payload
+
+    def read_frame(self, block=True):
+        # Returns (stream_id, frame_type, payload), or None if the connection was closed or, with
+        # block=False, if no complete frame has arrived yet (closed tells both apart)
+        while True:
+            frame = self._next_buffered()
+            if frame is not None or self.closed:
+                return frame
+            if block:
+                data = self.sock.recv(RECV_SIZE)
+            else:
+                timeout = self.sock.gettimeout()
+                self.sock.settimeout(0)
+                try:
+                    data = self.sock.recv(RECV_SIZE)
+                except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                    return None
+                finally:
+                    self.sock.settimeout(timeout)
+            if not data:
+                self.closed = True
+                return None
+            self.buffer += data
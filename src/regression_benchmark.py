@@ -0,0 +1,300 @@
+# Performance regression suite: runs Server and Client in-process over loopback across a fixed set
+# of scenarios, stores the results as a versioned JSON baseline and compares new runs against it.
+# Exits non-zero when throughput or p99 latency regressed, so it can gate deployments.
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import client
+from client import Client
+from multiplex import INITIAL_WINDOW
+from server import Server
+
+BASELINE_VERSION = 3
+BASELINE_FILE = 'performance_baseline.json'
+PAYLOAD_SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+CONCURRENCY_LEVELS = [1, 4]
+MULTIPLEXED_STREAMS = 4     # Files per connection in the multiplexed scenarios
+MULTIPLEXED_SIZE = 4 * INITIAL_WINDOW # Streams can only finish after window updates
+TRANSFER_TIMEOUT = 60       # seconds; a stalled transfer fails instead of hanging the suite
+REPETITIONS = 30
+WARMUP_REPETITIONS = 1      # Discarded rounds that warm up sockets, TLS sessions and caches
+THROUGHPUT_THRESHOLD = 0.10 # Allowed relative drop of the median throughput
+LATENCY_THRESHOLD = 0.50    # Allowed relative growth of the p99 latency (tails are much noisier)
+MIN_P99_SAMPLES = 100       # Below this a p99 is little more than the maximum, so it isn't tested
+BASELINE_PASSES = 3         # Independent passes recorded for a baseline, to measure run-to-run noise
+NOISE_FACTOR = 1.5          # Thresholds grow to this multiple of the noise seen between baseline passes
+BOOTSTRAP_ROUNDS = 1000
+CONFIDENCE = 0.95           # A regression must also be significant at this one-sided level
+
+def scenarios():
+    # (name, use_tls, size, concurrency, streams): streams > 1 sends that many files multiplexed
+    # over each connection instead of one file with the single-file protocol
+    for use_tls in (False, True):
+        for size in PAYLOAD_SIZES:
+            for concurrency in CONCURRENCY_LEVELS:
+                name = f"{'TLS' if use_tls else 'TCP'}-{size // 1024}KiB-c{concurrency}"
+                yield name, use_tls, size, concurrency, 1
+        name = f"{'TLS' if use_tls else 'TCP'}-{MULTIPLEXED_SIZE // 1024}KiB-mux{MULTIPLEXED_STREAMS}"
+        yield name, use_tls, MULTIPLEXED_SIZE, 1, MULTIPLEXED_STREAMS
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def start_server(use_tls):
+    server = Server('localhost', free_port(), use_tls)
+    server.thread = threading.Thread(target=server.start, daemon=True)
+    server.thread.start()
+    if not server.ready.wait(timeout=10):
+        raise RuntimeError("Benchmark server did not start listening")
+    return server
+
+def timed_transfer(port, use_tls, file_path, size, streams, latencies, failures):
+    # Latency covers the whole transfer as seen by a caller: connect, handshake, send and ACK.
+    # Client swallows connection and I/O errors, so a transfer only counts if all bytes were sent
+    # and the server acknowledged them.
+    start_time = time.perf_counter()
+    transfer_client = Client('localhost', port, use_tls)
+    transfer_client.connect()
+    if transfer_client.sock:
+        transfer_client.sock.settimeout(TRANSFER_TIMEOUT)
+    if streams > 1:
+        transfer_client.send_files_multiplexed([file_path] * streams)
+    else:
+        transfer_client.send_file(file_path)
+    if not transfer_client.stats['acknowledged'] or transfer_client.stats['data_size'] != size * streams:
+        failures.append(1)
+        return
+    latencies.append(time.perf_counter() - start_time)
+
+def run_round(server, use_tls, file_path, size, concurrency, streams, latencies, failures):
+    threads = [threading.Thread(target=timed_transfer,
+                                args=(server.port, use_tls, file_path, size, streams, latencies, failures))
+               for _ in range(concurrency)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time
+
+def run_scenarios(servers, repetitions):
+    # Rounds of all scenarios are interleaved, so a burst of load on the host spreads over every
+    # scenario's samples (where the median absorbs it) instead of skewing one scenario entirely
+    samples = {name: {'throughputs': [], 'latencies': [], 'failures': []} for name, *_ in scenarios()}
+    for repetition in range(WARMUP_REPETITIONS + repetitions):
+        for name, use_tls, size, concurrency, streams in scenarios():
+            if repetition < WARMUP_REPETITIONS:
+                run_round(servers[use_tls], use_tls, f'payload_{size}.bin', size, concurrency, streams, [], [])
+                continue
+            scenario = samples[name]
+            round_failures = len(scenario['failures'])
+            duration = run_round(servers[use_tls], use_tls, f'payload_{size}.bin', size, concurrency, streams,
+                                 scenario['latencies'], scenario['failures'])
+            if len(scenario['failures']) == round_failures:
+                scenario['throughputs'].append(size * concurrency * streams / duration)
+            wait_for_handlers(servers.values())
+    return {name: summarize(scenario['throughputs'], scenario['latencies'], len(scenario['failures']))
+            for name, scenario in samples.items()}
+
+def merge_passes(pass_results):
+    # Pool the samples of independent passes, and record how far the passes disagreed with each
+    # other: run-to-run noise of the host that no within-run statistic can see
+    results = {}
+    for name in pass_results[0]:
+        passes = [pass_result[name] for pass_result in pass_results]
+        result = summarize([value for result in passes for value in result['throughput_samples']],
+                           [value for result in passes for value in result['latency_samples']],
+                           sum(result['failures'] for result in passes))
+        medians = [result['throughput_median'] for result in passes]
+        p99s = [result['latency_p99'] for result in passes]
+        result['throughput_noise'] = max(medians) / min(medians) - 1 if min(medians) > 0 else 0.0
+        result['latency_noise'] = max(p99s) / min(p99s) - 1 if min(p99s) > 0 else 0.0
+        results[name] = result
+    return results
+
+def summarize(throughputs, latencies, failures):
+    return {'repetitions': len(throughputs),
+            'failures': failures,
+            'throughput_median': statistics.median(throughputs) if throughputs else 0.0,
+            'latency_median': statistics.median(latencies) if latencies else 0.0,
+            'latency_p99': percentile(latencies, 99) if latencies else 0.0,
+            'throughput_samples': throughputs,
+            'latency_samples': latencies,}
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+def bootstrap_ratio_bounds(baseline_samples, current_samples, statistic):
+    # One-sided CONFIDENCE bounds (low, high) of statistic(current) / statistic(baseline),
+    # from resampling both sample sets with replacement. Seeded so that reruns agree.
+    rng = random.Random(0)
+    ratios = []
+    for _ in range(BOOTSTRAP_ROUNDS):
+        base = statistic(rng.choices(baseline_samples, k=len(baseline_samples)))
+        current = statistic(rng.choices(current_samples, k=len(current_samples)))
+        ratios.append(current / base if base else math.inf)
+    ratios.sort()
+    tail = int((1 - CONFIDENCE) * BOOTSTRAP_ROUNDS)
+    return ratios[tail], ratios[BOOTSTRAP_ROUNDS - 1 - tail]
+
+def wait_for_handlers(servers):
+    # Server handler threads may still be logging after the client got its ACK. They inherit
+    # the daemon flag of the accept loop, so join everything except the accept loops themselves.
+    accept_threads = {server.thread for server in servers}
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and thread not in accept_threads:
+            thread.join()
+
+def run_suite(repetitions, passes=1):
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Server and certificate files are relative to the working directory
+        os.chdir(work_dir)
+        try:
+            results = _run_scenarios(repetitions, passes)
+        finally:
+            os.chdir(original_dir)
+    return results
+
+def _run_scenarios(repetitions, passes):
+    client.LOG_FILE = os.devnull # Keep benchmark transfers out of client_performance.log
+    client.MULTIPLEX_LOG_FILE = os.devnull
+    # Silence the per-transfer prints of Server/Client, the summary is printed afterwards
+    with contextlib.redirect_stdout(io.StringIO()):
+        from generate_server_key import generate_self_signed_cert
+        generate_self_signed_cert()
+        for size in set(PAYLOAD_SIZES + [MULTIPLEXED_SIZE]):
+            with open(f'payload_{size}.bin', 'wb') as payload:
+                payload.write(os.urandom(size))
+
+        servers = {use_tls: start_server(use_tls) for use_tls in (False, True)}
+        results = merge_passes([run_scenarios(servers, repetitions) for _ in range(passes)])
+
+    for name, result in results.items():
+        failed = f"  {result['failures']} FAILED" if result['failures'] else ''
+        print(f"{name:<20} {result['throughput_median'] / (1024 * 1024):10.2f} MB/s  "
+              f"p99 {result['latency_p99'] * 1000:8.3f} ms{failed}")
+    return results
+
+def count_failures(results):
+    return sum(result['failures'] for result in results.values())
+
+def compare(baseline, results, throughput_threshold, latency_threshold):
+    # Returns the list of regression messages, empty if the run is within the thresholds
+    regressions = []
+    untested_p99 = []
+    for name, current in results.items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            print(f"{name}: no baseline, skipped")
+            continue
+        if not current['throughput_samples'] or not base['throughput_samples']:
+            continue # Failed scenarios are reported separately
+
+        # Throughput: the median must drop by more than both the threshold and the noise seen
+        # between baseline passes, and the drop must be significant (the upper confidence bound
+        # of the ratio stays below 1)
+        allowed_drop = max(throughput_threshold, NOISE_FACTOR * base.get('throughput_noise', 0.0))
+        ratio = current['throughput_median'] / base['throughput_median']
+        _, upper = bootstrap_ratio_bounds(base['throughput_samples'], current['throughput_samples'],
+                                          statistics.median)
+        if ratio < 1 - allowed_drop and upper < 1:
+            regressions.append(f"{name}: throughput {current['throughput_median'] / (1024 * 1024):.2f} MB/s vs "
+                               f"baseline {base['throughput_median'] / (1024 * 1024):.2f} MB/s "
+                               f"({(ratio - 1) * 100:.1f}%)")
+
+        # p99 latency: same test, but only once there are enough samples for a meaningful tail
+        if min(len(base['latency_samples']), len(current['latency_samples'])) < MIN_P99_SAMPLES:
+            untested_p99.append(name)
+            continue
+        allowed_growth = max(latency_threshold, NOISE_FACTOR * base.get('latency_noise', 0.0))
+        ratio = current['latency_p99'] / base['latency_p99']
+        lower, _ = bootstrap_ratio_bounds(base['latency_samples'], current['latency_samples'],
+                                          lambda samples: percentile(samples, 99))
+        if ratio > 1 + allowed_growth and lower > 1:
+            regressions.append(f"{name}: p99 latency {current['latency_p99'] * 1000:.3f} ms vs "
+                               f"baseline {base['latency_p99'] * 1000:.3f} ms "
+                               f"(+{(ratio - 1) * 100:.1f}%)")
+    if untested_p99:
+        print(f"p99 latency not tested, fewer than {MIN_P99_SAMPLES} samples (raise --repetitions): "
+              f"{', '.join(untested_p99)}")
+    return regressions
+
+def load_baseline(file_path):
+    try:
+        with open(file_path, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    except (IOError, ValueError) as e:
+        print(f"Failed to load baseline {file_path}: {e}")
+        return None
+    if baseline.get('version') != BASELINE_VERSION:
+        print(f"Baseline {file_path} has version {baseline.get('version')}, expected {BASELINE_VERSION}. "
+              f"Re-create it with --update-baseline.")
+        return None
+    return baseline
+
+def save_baseline(file_path, results):
+    baseline = {'version': BASELINE_VERSION,
+                'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scenarios': results,}
+    with open(file_path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+    print(f"Baseline saved to {file_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the loopback performance regression suite.')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Path to the baseline JSON file.')
+    parser.add_argument('--update-baseline', action='store_true', help='Store this run as the new baseline.')
+    parser.add_argument('--repetitions', type=int, default=REPETITIONS, help='Repetitions per scenario.')
+    parser.add_argument('--passes', type=int, default=BASELINE_PASSES,
+                        help='Independent passes recorded with --update-baseline, to measure run-to-run noise.')
+    parser.add_argument('--throughput-threshold', type=float, default=THROUGHPUT_THRESHOLD,
+                        help='Allowed relative median throughput drop before failing.')
+    parser.add_argument('--latency-threshold', type=float, default=LATENCY_THRESHOLD,
+                        help='Allowed relative p99 latency growth before failing.')
+    args = parser.parse_args()
+    baseline_path = os.path.abspath(args.baseline)
+
+    baseline = None
+    if not args.update_baseline:
+        baseline = load_baseline(baseline_path)
+        if baseline is None:
+            sys.exit(2)
+
+    results = run_suite(args.repetitions, args.passes if args.update_baseline else 1)
+
+    failures = count_failures(results)
+    if failures:
+        print(f"\n{failures} transfer(s) failed, results are not comparable.")
+        sys.exit(1)
+
+    if args.update_baseline:
+        save_baseline(baseline_path, results)
+        sys.exit(0)
+
+    regressions = compare(baseline, results, args.throughput_threshold, args.latency_threshold)
+    if regressions:
+        print(f"\n{len(regressions)} performance regression(s) against {baseline_path}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"\nNo performance regressions against {baseline_path}.")
@@ -1,7 +1,7 @@
 # File to run performance tests by sending files of various sizes to the server and generating performance graphs
 import os
 from client import Client
-from graph_data import load_performance_data, create_graph
+from graph_data import load_performance_data, load_memory_data, load_rss_samples, render_all_graphs
 from graph_data import analyze_performance as ap
 from generate_server_key import generate_self_signed_cert
 import time
@@ -23,7 +23,10 @@ def run_performance_tests(use_tls, port):
 def analyze_performance():
     performance_data = load_performance_data('client_performance.log')
     ap(performance_data)
-    create_graph(performance_data)
+    # Memory logs are only present when the server was started with --memory
+    render_all_graphs(performance_data,
+                      memory_data=load_memory_data('server_memory.log'),
+                      rss_samples=load_rss_samples('server_rss_samples.log'))
     print("Performance tests completed.")
 
 if __name__ == "__main__":
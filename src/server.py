@@ -7,17 +7,37 @@ import threading
 import time
 import argparse
 import os
+import math
+import hashlib
 from datetime import datetime
+from tracing import Tracer, NULL_TRACER
+from memory_profile import MemoryMonitor, NULL_MONITOR, log_memory_usage
+from bandwidth import BandwidthScheduler, NULL_SCHEDULER
+from dedup import (DEDUP_MAGIC, DIGEST_SIZE, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, CHUNK_STORE_MAX_BYTES,
+                   ChunkStore)
+from multiplex import (MUX_MAGIC, FRAME_OPEN, FRAME_DATA, FRAME_END, FRAME_WINDOW, FRAME_ACK,
+                       INITIAL_WINDOW, ProtocolError, pack_frame, read_frame, recv_exact)
 
 BUFFER_SIZE = 4096
 HOST = 'localhost'
 FILE_SAVE_PATH = 'received_files/'
+MEMORY_LOG_FILE = 'server_memory.log'
+RSS_SAMPLES_FILE = 'server_rss_samples.log'
 
 class Server:
-    def __init__(self, host, port, use_tls):
+    def __init__(self, host, port, use_tls, tracer=None, trace_file=None, memory=None, bandwidth=None,
+                 chunk_store=None, chunk_store_size=CHUNK_STORE_MAX_BYTES):
         self.host = host
         self.port = port
         self.use_tls = use_tls
+        self.tracer = tracer or NULL_TRACER
+        self.trace_file = trace_file
+        self.memory = memory or NULL_MONITOR
+        self.bandwidth = bandwidth or NULL_SCHEDULER # Shared by all handler threads
+        self.chunk_store = chunk_store # Created on the first deduplicated connection when not given
+        self.chunk_store_size = chunk_store_size
+        self.chunk_store_lock = threading.Lock()
+        self.ready = threading.Event() # Set once the server socket is listening
     
     def start(self):
         os.makedirs(FILE_SAVE_PATH, exist_ok=True) # Ensure the directory for saving files exists
@@ -26,6 +46,8 @@ class Server:
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
         server_socket.listen(5) # Allow up to 5 queued connections
+        self.ready.set()
+        self.memory.start()
 
         print(f"Server listening on {self.host}:{self.port} {'with TLS' if self.use_tls else 'without TLS'}")
 
@@ -35,50 +57,77 @@ class Server:
             context.load_cert_chain(certfile='server.crt', keyfile='server.key')
         try:
             while True:
-                conn, addr = server_socket.accept()
+                with self.tracer.span('accept') as span:
+                    conn, addr = server_socket.accept()
+                    span.set(peer=f"{addr[0]}:{addr[1]}")
                 if self.use_tls:
-                    conn = context.wrap_socket(conn, server_side=True) # Wrap accepted socket with TLS
+                    with self.tracer.span('tls_handshake', peer=f"{addr[0]}:{addr[1]}"):
+                        conn = context.wrap_socket(conn, server_side=True) # Wrap accepted socket with TLS
                 client_thread = threading.Thread(target=self.handle_client, args=(conn, addr)) # Handle each client in a new thread
                 client_thread.start()
         except KeyboardInterrupt:
             print("Server shutting down.")
         finally:
             server_socket.close()
+            if self.trace_file:
+                self.tracer.save(self.trace_file)
+            self.memory.stop()
+            self.bandwidth.print_summary()
+            if self.chunk_store is not None:
+                self.chunk_store.flush()
     
     def handle_client(self, conn, addr):
         print(f"Connection from {addr} has been established.")
         start_time = time.time()
         total_data_received = 0
+        throttled_time = 0.0
+        protocol = 'single'
+        memory_usage = self.memory.begin()
 
         data_chunks = []
         try:
             # First, receive the file size (8 bytes) - ensure we get exactly 8 bytes
             size_data = b''
-            while len(size_data) < 8:
-                chunk = conn.recv(8 - len(size_data))
-                if not chunk:
-                    print(f"Connection closed while receiving header from {addr}")
-                    return
-                size_data += chunk
+            with self.tracer.span('header_read'):
+                while len(size_data) < 8:
+                    chunk = conn.recv(8 - len(size_data))
+                    if not chunk:
+                        print(f"Connection closed while receiving header from {addr}")
+                        return
+                    size_data += chunk
+
+            if size_data == MUX_MAGIC:
+                protocol = 'multiplex'
+                total_data_received = self.handle_multiplexed(conn, addr)
+                return
+            if size_data == DEDUP_MAGIC:
+                protocol = 'dedup'
+                total_data_received = self.handle_dedup(conn, addr)
+                return
             
             expected_size = int.from_bytes(size_data, byteorder='big')
             print(f"Expecting {expected_size} bytes from {addr}")
             
             # Now receive exactly that many bytes
-            while total_data_received < expected_size:
-                remaining = expected_size - total_data_received
-                chunk_size = min(BUFFER_SIZE, remaining)
-                try:
-                    data = conn.recv(chunk_size)
-                    if not data:
+            with self.tracer.span('receive', expected_bytes=expected_size):
+                while total_data_received < expected_size:
+                    remaining = expected_size - total_data_received
+                    chunk_size = min(BUFFER_SIZE, remaining)
+                    try:
+                        with self.tracer.chunk_span('recv', len(data_chunks)) as span:
+                            data = conn.recv(chunk_size)
+                            span.set(bytes=len(data))
+                        if not data:
+                            break
+                        total_data_received += len(data)
+                        data_chunks.append(data)
+                        throttled_time += self.bandwidth.throttle(addr[0], len(data))
+                    except (ConnectionResetError, BrokenPipeError, ssl.SSLError) as recv_error:
+                        print(f"Error receiving data from {addr}: {recv_error}")
                         break
-                    total_data_received += len(data)
-                    data_chunks.append(data)
-                except (ConnectionResetError, BrokenPipeError, ssl.SSLError) as recv_error:
-                    print(f"Error receiving data from {addr}: {recv_error}")
-                    break
 
-            data = b''.join(data_chunks)
+            with self.tracer.span('join', chunks=len(data_chunks)):
+                data = b''.join(data_chunks)
             end_time = time.time()
             duration = end_time - start_time
 
@@ -90,15 +139,185 @@ class Server:
             # Send acknowledgment
             try:
                 ack_message = "File received successfully.".encode('utf-8')
-                conn.sendall(ack_message)
+                with self.tracer.span('ack_send'):
+                    conn.sendall(ack_message)
             except (ConnectionResetError, BrokenPipeError, ssl.SSLError) as send_error:
                 print(f"Error sending acknowledgment to {addr}: {send_error}")
 
-            print(f"Connection from {addr} closed. Received {total_data_received} bytes in {duration:.6f} seconds.")
+            print(f"Connection from {addr} closed. Received {total_data_received} bytes in {duration:.6f} seconds"
+                  f"{f' (throttled for {throttled_time:.6f} seconds)' if throttled_time else ''}.")
         except Exception as e:
             print(f"Unexpected error from {addr}: {e}")
         finally:
             conn.close()
+            memory_usage = self.memory.end(memory_usage)
+            if memory_usage:
+                log_memory_usage(MEMORY_LOG_FILE, 'TLS' if self.use_tls else 'TCP', protocol,
+                                 total_data_received, time.time() - start_time, memory_usage)
+
+    def handle_multiplexed(self, conn, addr):
+        # Demultiplex frames from a single connection into per-stream sinks
+        print(f"Connection from {addr} is using the multiplexed protocol.")
+        streams = {}
+        frame_index = 0
+        total_data_received = 0
+        throttled_time = 0.0
+        try:
+            while True:
+                with self.tracer.chunk_span('read_frame', frame_index):
+                    frame = read_frame(conn)
+                frame_index += 1
+                if frame is None:
+                    break
+                stream_id, frame_type, payload = frame
+
+                if frame_type == FRAME_OPEN:
+                    if stream_id in streams:
+                        raise ProtocolError(f"Stream {stream_id} is already open")
+                    streams[stream_id] = {'name': payload[8:].decode('utf-8'),
+                                          'expected_size': int.from_bytes(payload[:8], byteorder='big'),
+                                          'received': 0,
+                                          'window': INITIAL_WINDOW,
+                                          'consumed': 0,
+                                          'chunks': [],
+                                          'start_time': time.time(),}
+                    continue
+
+                stream = streams.get(stream_id)
+                if stream is None:
+                    raise ProtocolError(f"Frame for unknown stream {stream_id}")
+
+                if frame_type == FRAME_DATA:
+                    if len(payload) > stream['window']:
+                        raise ProtocolError(f"Stream {stream_id} exceeded its flow-control window")
+                    stream['window'] -= len(payload)
+                    stream['received'] += len(payload)
+                    stream['consumed'] += len(payload)
+                    stream['chunks'].append(payload)
+                    total_data_received += len(payload)
+                    throttled_time += self.bandwidth.throttle(addr[0], len(payload))
+                    # Grant more window once half of it has been consumed
+                    if stream['consumed'] >= INITIAL_WINDOW // 2:
+                        increment = stream['consumed']
+                        stream['window'] += increment
+                        stream['consumed'] = 0
+                        conn.sendall(pack_frame(stream_id, FRAME_WINDOW, increment.to_bytes(4, byteorder='big')))
+                elif frame_type == FRAME_END:
+                    del streams[stream_id]
+                    with self.tracer.span('join', stream=stream_id, chunks=len(stream['chunks'])):
+                        data = b''.join(stream['chunks'])
+                    duration = time.time() - stream['start_time']
+                    print(f"Received {stream['received']} bytes of '{stream['name']}' (stream {stream_id}) "
+                          f"from {addr} in {duration:.6f} seconds.")
+                    if stream['received'] != stream['expected_size']:
+                        # Not acknowledged: closing the connection tells the client the stream failed
+                        raise ProtocolError(f"Stream {stream_id} ended after {stream['received']} bytes, "
+                                            f"expected {stream['expected_size']}")
+                    #timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    #self.save_received_file(data, f"received_from_{addr[0]}_{addr[1]}_{timestamp}_{stream['name']}")
+                    with self.tracer.span('ack_send', stream=stream_id):
+                        conn.sendall(pack_frame(stream_id, FRAME_ACK, "File received successfully.".encode('utf-8')))
+                else:
+                    raise ProtocolError(f"Unexpected frame type {frame_type} on stream {stream_id}")
+        except ProtocolError as e:
+            print(f"Protocol error from {addr}: {e}")
+        except (ConnectionResetError, BrokenPipeError, ssl.SSLError) as conn_error:
+            print(f"Error on multiplexed connection from {addr}: {conn_error}")
+
+        if streams:
+            print(f"Connection from {addr} closed with {len(streams)} incomplete streams.")
+        print(f"Multiplexed connection from {addr} closed. Received {total_data_received} bytes"
+              f"{f' (throttled for {throttled_time:.6f} seconds)' if throttled_time else ''}.")
+        return total_data_received
+
+    def _get_chunk_store(self):
+        # Created lazily so servers that never see a deduplicated transfer don't create chunk_store/
+        with self.chunk_store_lock:
+            if self.chunk_store is None:
+                self.chunk_store = ChunkStore(max_bytes=self.chunk_store_size)
+            return self.chunk_store
+
+    def handle_dedup(self, conn, addr):
+        # Receive a file as a list of chunk digests plus only the chunks missing from the store.
+        # Returns the file size once received, whatever part of it went over the wire, otherwise the
+        # bytes received before the transfer failed
+        print(f"Connection from {addr} is using the deduplicated protocol.")
+        chunk_store = self._get_chunk_store()
+        start_time = time.time()
+        total_data_received = 0
+        throttled_time = 0.0
+        try:
+            with self.tracer.span('header_read'):
+                header = recv_exact(conn, 12)
+                if header is None:
+                    print(f"Connection closed while receiving header from {addr}")
+                    return 0
+                expected_size = int.from_bytes(header[:8], byteorder='big')
+                chunk_count = int.from_bytes(header[8:], byteorder='big')
+                # Every chunk but the last is between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE bytes
+                min_count = -(-expected_size // MAX_CHUNK_SIZE)
+                max_count = expected_size // MIN_CHUNK_SIZE + 1 if expected_size else 0
+                if not min_count <= chunk_count <= max_count:
+                    print(f"Rejected {chunk_count} chunks for a {expected_size} byte file from {addr}.")
+                    return 0
+                digest_data = recv_exact(conn, chunk_count * DIGEST_SIZE)
+                if digest_data is None:
+                    print(f"Connection closed while receiving chunk list from {addr}")
+                    return 0
+            digests = [digest_data[i:i + DIGEST_SIZE] for i in range(0, len(digest_data), DIGEST_SIZE)]
+            unique_digests = list(dict.fromkeys(digests))
+
+            with self.tracer.span('chunk_lookup', chunks=len(unique_digests)):
+                chunks = chunk_store.lookup(unique_digests)
+            missing = [digest for digest in unique_digests if digest not in chunks]
+            conn.sendall(len(missing).to_bytes(4, byteorder='big') + b''.join(missing))
+
+            with self.tracer.span('receive', missing_chunks=len(missing)):
+                for index, digest in enumerate(missing):
+                    with self.tracer.chunk_span('recv_chunk', index):
+                        length_data = recv_exact(conn, 4)
+                        if length_data is None:
+                            print(f"Connection closed while receiving chunks from {addr}")
+                            return total_data_received
+                        chunk_length = int.from_bytes(length_data, byteorder='big')
+                        if not 0 < chunk_length <= MAX_CHUNK_SIZE:
+                            print(f"Rejected a {chunk_length} byte chunk from {addr}.")
+                            return total_data_received
+                        chunk = recv_exact(conn, chunk_length)
+                    if chunk is None:
+                        print(f"Connection closed while receiving chunks from {addr}")
+                        return total_data_received
+                    if hashlib.sha256(chunk).digest() != digest:
+                        print(f"Chunk {digest.hex()} from {addr} doesn't match its digest.")
+                        return total_data_received
+                    total_data_received += len(chunk)
+                    throttled_time += self.bandwidth.throttle(addr[0], len(chunk))
+                    chunks[digest] = chunk
+                    chunk_store.put(digest, chunk)
+
+            with self.tracer.span('join', chunks=len(digests)):
+                data = b''.join(chunks[digest] for digest in digests)
+            duration = time.time() - start_time
+
+            if len(data) != expected_size:
+                print(f"Reassembled {len(data)} bytes from {addr}, expected {expected_size}.")
+                return total_data_received
+            print(f"Received {len(data)} bytes from {addr} in {duration:.6f} seconds, "
+                  f"{total_data_received} over the wire ({len(unique_digests) - len(missing)}/{len(unique_digests)} "
+                  f"chunks deduplicated, store hit rate {chunk_store.hit_rate() * 100:.1f}%)"
+                  f"{f', throttled for {throttled_time:.6f} seconds' if throttled_time else ''}.")
+            #timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            #self.save_received_file(data, f"received_from_{addr[0]}_{addr[1]}_{timestamp}.bin")
+
+            with self.tracer.span('ack_send'):
+                conn.sendall("File received successfully.".encode('utf-8'))
+            return expected_size
+        except (ConnectionResetError, BrokenPipeError, ssl.SSLError) as conn_error:
+            print(f"Error on deduplicated connection from {addr}: {conn_error}")
+            return total_data_received
+        finally:
+            # Chunks stored by put() must be indexed even when the transfer was aborted
+            chunk_store.flush()
 
     def save_received_file(self, data, filename):
         try:
@@ -112,7 +331,37 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Start a simple server with optional TLS.')
     parser.add_argument('--tls', action='store_true', help='Enable TLS for the server.') # Add argument to enable TLS
     parser.add_argument('--port', type=int, default=65432, help='Port number for the server to listen on.')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace-event JSON of transfer spans to FILE on shutdown.')
+    parser.add_argument('--trace-sample', type=int, default=64, help='Record one in every N per-chunk recv spans when tracing.')
+    parser.add_argument('--memory', action='store_true',
+                        help=f'Log peak traced memory per connection to {MEMORY_LOG_FILE} and sample RSS to {RSS_SAMPLES_FILE}.')
+    parser.add_argument('--rate-limit', type=float, help='Global ingest limit in bytes/second, shared fairly between clients.')
+    parser.add_argument('--client-rate-limit', type=float, help='Ingest limit per client IP in bytes/second.')
+    parser.add_argument('--client-weight', action='append', default=[], metavar='IP=WEIGHT',
+                        help='Weight of a client IP in the global rate sharing (default 1). Can be repeated.')
+    parser.add_argument('--chunk-store-size', type=int, default=CHUNK_STORE_MAX_BYTES,
+                        help='Maximum size in bytes of the chunk store used by deduplicated transfers.')
     args = parser.parse_args()
 
-    server = Server(HOST, args.port, args.tls)
+    for option, rate in (('--rate-limit', args.rate_limit), ('--client-rate-limit', args.client_rate_limit)):
+        if rate is not None and not 0 < rate < math.inf: # Also rejects nan
+            parser.error(f"invalid {option} {rate}, the rate must be a positive number of bytes/second")
+
+    client_weights = {}
+    for entry in args.client_weight:
+        client_ip, _, weight = entry.partition('=')
+        try:
+            client_weights[client_ip] = float(weight)
+        except ValueError:
+            parser.error(f"invalid --client-weight '{entry}', expected IP=WEIGHT")
+        if not 0 < client_weights[client_ip] < math.inf: # Also rejects nan
+            parser.error(f"invalid --client-weight '{entry}', the weight must be a positive number")
+
+    tracer = Tracer(enabled=True, sample_every=args.trace_sample) if args.trace else None
+    memory = MemoryMonitor(enabled=True, samples_file=RSS_SAMPLES_FILE) if args.memory else None
+    bandwidth = None
+    if args.rate_limit is not None or args.client_rate_limit is not None:
+        bandwidth = BandwidthScheduler(args.rate_limit, args.client_rate_limit, client_weights)
+    server = Server(HOST, args.port, args.tls, tracer, args.trace, memory, bandwidth,
+                    chunk_store_size=args.chunk_store_size)
     server.start()
@@ -0,0 +1,96 @@
+# Opt-in tracing of the transfer hot paths, written as Chrome trace-event JSON
+# (load the output file in https://ui.perfetto.dev or chrome://tracing).
+import json
+import os
+import threading
+import time
+
+class _NullSpan:
+    # Shared no-op context manager returned when tracing is disabled or a chunk is not sampled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._record(self.name, self.cat, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        # Attach values only known once the span is running (e.g. bytes received)
+        self.args.update(args)
+
+class Tracer:
+    def __init__(self, enabled=False, sample_every=1):
+        self.enabled = enabled
+        self.sample_every = max(1, sample_every)
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def span(self, name, cat='transfer', **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def chunk_span(self, name, index, **args):
+        # Per-chunk spans are sampled so tracing large transfers doesn't distort them
+        if not self.enabled or index % self.sample_every:
+            return _NULL_SPAN
+        args['chunk'] = index
+        return _Span(self, name, 'chunk', args)
+
+    def _record(self, name, cat, start_ns, end_ns, args):
+        tid = threading.get_ident()
+        event = {'name': name,
+                 'cat': cat,
+                 'ph': 'X',
+                 'ts': start_ns / 1000,
+                 'dur': (end_ns - start_ns) / 1000,
+                 'pid': self.pid,
+                 'tid': tid,
+                 'args': args,}
+        with self.lock:
+            self.events.append(event)
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+
+    def save(self, file_path):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+        # Name the threads so Perfetto shows them instead of raw thread IDs
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                     'args': {'name': name}} for tid, name in thread_names.items()]
+        try:
+            with open(file_path, 'w') as trace_file:
+                json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, trace_file)
+            print(f"Saved trace with {len(events)} events to {file_path}")
+        except IOError as e:
+            print(f"Failed to write trace file {file_path}: {e}")
+
+# Default tracer used when none is passed in; disabled, so spans cost a single attribute check
+NULL_TRACER = Tracer(enabled=False)